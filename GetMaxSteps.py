@@ -1,5 +1,6 @@
 import random
-from lib.libChess import ChessBoard
+import numpy as np
+from lib.libChess import ChessBoard, ChessTemplate
 
 chess_countr = {"A": 10, "B": 10, "C": 8}
 
@@ -10,14 +11,81 @@ class Individual:
         self.chess_seq = chess_seq  # list of chess types
         self.flip_seq = flip_seq  # list of booleans
         self.fitness = 0
+        self.consumed = 0  # number of chesses placed by the walk
+        self.board = None
 
     def calculate_fitness(self, chessboard_size):
         # Create a new chessboard for each fitness calculation
         self.board = ChessBoard(size=chessboard_size)
-        steps = self.board.count_steps(self.start_pos, self.start_angle, self.chess_seq.copy(), self.flip_seq.copy())
+        chess_seq = self.chess_seq.copy()
+        steps = self.board.count_steps(self.start_pos, self.start_angle, chess_seq, self.flip_seq.copy())
+        # count_steps pops placed chesses and the appended end chess
+        self.consumed = min(len(self.chess_seq) + 1 - len(chess_seq), len(self.chess_seq))
         self.fitness = steps
         return steps
 
+class GenomeArchive:
+    # Effective genomes (start state plus consumed chesses) already evaluated, as a trie
+    # rooted at the start state with one edge per chess. A walk that stopped after k chesses
+    # replays identically for any genome sharing that prefix, so no stored prefix extends
+    # another and every lookup ends at a leaf or a missing edge.
+    # Edges live in one flat int -> int dict (node * 8 + gene -> child node, or a negative
+    # leaf packing fitness and consumed) so the garbage collector never scans the archive.
+    genes = {"A": (0, 0), "B": (1, 2), "C": (3, 4)}  # indexed by flip, flipping A changes nothing
+
+    def __init__(self):
+        self.roots = {}
+        self.edges = {}
+        self.nodes = 0
+        self.size = 0
+
+    def lookup(self, individual):
+        # Follows the genome until a leaf or the first chess no evaluated genome shares.
+        # Returns (fitness, consumed) for a duplicate, otherwise None and where to insert it.
+        genes, edges = self.genes, self.edges
+        node = self.roots.get((individual.start_pos, individual.start_angle))
+        if node is None:
+            return None, (None, 0)
+        depth = 0
+        for c, f in zip(individual.chess_seq, individual.flip_seq):
+            if node < 0:
+                break
+            child = edges.get(node * 8 + genes[c][f])
+            if child is None:
+                return None, (node, depth)
+            node = child
+            depth += 1
+        return divmod(-1 - node, 32), None
+
+    def add(self, individual, position):
+        # position is what lookup returned for the individual, the shared prefix is not walked again
+        genes, edges = self.genes, self.edges
+        node, depth = position
+        consumed = individual.consumed
+        leaf = -1 - (individual.fitness * 32 + consumed)
+        self.size += 1
+        if consumed == 0:
+            self.roots[(individual.start_pos, individual.start_angle)] = leaf
+            return
+        if node is None:
+            node = self.nodes
+            self.roots[(individual.start_pos, individual.start_angle)] = node
+            self.nodes += 1
+        for c, f in zip(individual.chess_seq[depth:consumed - 1], individual.flip_seq[depth:consumed - 1]):
+            edges[node * 8 + genes[c][f]] = self.nodes
+            node = self.nodes
+            self.nodes += 1
+        edges[node * 8 + genes[individual.chess_seq[consumed - 1]][individual.flip_seq[consumed - 1]]] = leaf
+
+    def __len__(self):
+        return self.size
+
+def effective_genome(individual, consumed):
+    # Hashable start state plus the genes of the first consumed chesses
+    genes = GenomeArchive.genes
+    return (individual.start_pos, individual.start_angle,
+            tuple(genes[c][f] for c, f in zip(individual.chess_seq[:consumed], individual.flip_seq[:consumed])))
+
 def generate_population(population_size, chessboard_size):
     population = []
     base_chess = ["A"] * chess_countr["A"] + ["B"] * chess_countr["B"] + ["C"] * chess_countr["C"]
@@ -126,17 +194,62 @@ def mutate(individual, mutation_rate):
         if random.random() < mutation_rate * 2:
             individual.flip_seq[i] = not individual.flip_seq[i]
 
-def genetic_algorithm(population_size=100, max_generations=100):
+def perturb(individual, consumed, chessboard_size):
+    # Smallest change that leaves a duplicate's consumed prefix. A walk that consumed
+    # nothing left the board from the start, so turn it onto the board. Otherwise change
+    # one chess of the prefix, preferably the last one after which the walk stopped.
+    if consumed == 0:
+        x, y = individual.start_pos
+        max_x, max_y = chessboard_size
+        individual.start_angle = random.choice([angle for angle, (dx, dy) in enumerate(ChessTemplate._angle_pos)
+                                                if 0 <= x + dx < max_x and 0 <= y + dy < max_y])
+        return
+    chess_seq, flip_seq = individual.chess_seq, individual.flip_seq
+    i = consumed - 1 if random.random() < 0.5 else random.randrange(consumed)
+    if chess_seq[i] != "A" and random.random() < 0.5:
+        flip_seq[i] = not flip_seq[i]
+    else:
+        j = random.randrange(len(chess_seq))
+        while chess_seq[j] == chess_seq[i]:
+            j = random.randrange(len(chess_seq))
+        chess_seq[i], chess_seq[j] = chess_seq[j], chess_seq[i]
+        flip_seq[i], flip_seq[j] = flip_seq[j], flip_seq[i]
+
+def evaluate_unique(individual, archive, chessboard_size, max_retries=1):
+    # Perturb duplicates of already evaluated genomes, fall back to the archived fitness.
+    # Returns the effective genome the individual had before perturbing, whether that
+    # collided with the archive and whether the individual ended up new.
+    genome = None
+    for attempt in range(max_retries + 1):
+        found, position = archive.lookup(individual)
+        if found is None:
+            individual.calculate_fitness(chessboard_size)
+            archive.add(individual, position)
+            if genome is None:
+                genome = effective_genome(individual, individual.consumed)
+            return genome, attempt > 0, True
+        if genome is None:
+            genome = effective_genome(individual, found[1])
+        if attempt < max_retries:
+            perturb(individual, found[1], chessboard_size)
+    individual.fitness, individual.consumed = found
+    return genome, True, False
+
+def genetic_algorithm(population_size=100, max_generations=100, min_diversity=0.8, archive_size=500000, history=None, seeds=None):
     chessboard_size = (6, 6)
     mutation_rate = 0.4
     elite_size = population_size // 10  # Number of elite individuals to carry over
     best_fitness = 0
     best_Gen =  0
+    restarts = 0
+    initial_diversity = None
+    archive = GenomeArchive()
 
-    # Initialize population
-    population = generate_population(population_size, chessboard_size)
+    # Initialize population, seed individuals (e.g. a beam_search result) take the first slots
+    seeds = [Individual(s.start_pos, s.start_angle, s.chess_seq.copy(), s.flip_seq.copy()) for s in seeds or []]
+    population = seeds + generate_population(population_size - len(seeds), chessboard_size)
     for individual in population:
-        individual.calculate_fitness(chessboard_size)
+        evaluate_unique(individual, archive, chessboard_size)
 
     for generation in range(max_generations):
         # print(f"Generation {generation + 1}")
@@ -149,17 +262,54 @@ def genetic_algorithm(population_size=100, max_generations=100):
         elites = sorted_population[:elite_size]
         new_population.extend(elites)
 
+        # Keep the archive bounded, the current population is still known
+        if len(archive) > archive_size:
+            archive = GenomeArchive()
+            for individual in population:
+                found, position = archive.lookup(individual)
+                if found is None:
+                    archive.add(individual, position)
+
         # Generate offspring
+        genomes = {effective_genome(elite, elite.consumed) for elite in elites}
+        collisions = 0
+        duplicates = 0
         for _ in range(population_size - elite_size):
             parent1 = random.choice(parents)
             parent2 = random.choice(parents)
             child = crossover(parent1, parent2)
             mutate(child, mutation_rate)
-            child.calculate_fitness(chessboard_size)
+            genome, collided, unique = evaluate_unique(child, archive, chessboard_size)
+            genomes.add(genome)
+            collisions += collided
+            duplicates += not unique
             new_population.append(child)
         # Replace population
         population = new_population
 
+        # Share of distinct effective genomes in the generation as crossover and mutation produced it
+        diversity = len(genomes) / population_size
+        # Share of offspring not seen anywhere earlier in the run, falls as the archive grows
+        novelty = 1 - collisions / (population_size - elite_size)
+        if initial_diversity is None:
+            initial_diversity = diversity
+        # Restart from random individuals around the best one when the population collapses.
+        # Short walks collide more often in large populations, so the threshold is relative to
+        # the first generation: about 0.75 / 0.66 / 0.61 at sizes 1000 / 2500 / 4500, converging
+        # to roughly 0.7-0.8 of that after a few hundred generations. Keeping the elites or
+        # adding a few immigrants does not help, the elites win the tournaments again within
+        # a handful of generations.
+        if diversity < min_diversity * initial_diversity:
+            best_individual = max(population, key=lambda x: x.fitness)
+            newcomers = generate_population(population_size - 1, chessboard_size)
+            for individual in newcomers:
+                evaluate_unique(individual, archive, chessboard_size)
+            population = [best_individual] + newcomers
+            restarts += 1
+        if history is not None:
+            history.append({"generation": generation, "diversity": diversity, "novelty": novelty,
+                            "collisions": collisions, "duplicates": duplicates})
+
         # Get best individual
         best_individual = max(population, key=lambda x: x.fitness)
         # print(f"Best Fitness: {best_individual.fitness}, Start Pos: {best_individual.start_pos}, Start Angle: {best_individual.start_angle}")
@@ -167,19 +317,204 @@ def genetic_algorithm(population_size=100, max_generations=100):
             best_fitness = best_individual.fitness
             best_Gen = generation
 
-    print(f"Best Fitness: {best_fitness}, Generation: {best_Gen} / {max_generations}, population size: {population_size}")
-    return max(population, key=lambda x: x.fitness)
+    print(f"Best Fitness: {best_fitness}, Generation: {best_Gen} / {max_generations}, population size: {population_size}, restarts: {restarts}")
+    best = max(population, key=lambda x: x.fitness)
+    if best.board is None:
+        # Fitness came from the archive, replay the walk to get its board
+        best.calculate_fitness(chessboard_size)
+    return best
+
+def build_move_tables():
+    # Encode every placed chess state (ctype, rotation) as a small integer so the walk
+    # can be advanced for a whole beam with numpy lookups instead of chess objects.
+    # code 0 is an empty cell.
+    codes = {}
+    next_rows = [[-1] * 8]
+
+    def state_code(chess):
+        key = (chess.ctype, chess.rotation)
+        if key not in codes:
+            codes[key] = len(next_rows)
+            next_angles = [chess.move(a)[0] for a in range(8)]
+            next_rows.append([-1 if a is None else a for a in next_angles])
+        return codes[key]
+
+    board = ChessBoard()
+    start_codes = []
+    for angle in range(8):
+        chess = board.chesses["S"]()
+        chess.move(angle)
+        start_codes.append(state_code(chess))
+
+    # One choice per (ctype, flip) pair whose placement behaviour is distinct
+    choices = []
+    place_codes = []
+    place_angles = []
+    for ctype in chess_countr:
+        seen = []
+        for flip in (False, True):
+            codes_row, angles_row = [], []
+            for angle in range(8):
+                chess = board.chesses[ctype](flip)
+                next_angle, _ = chess.move(angle)
+                codes_row.append(state_code(chess))
+                angles_row.append(-1 if next_angle is None else next_angle)
+            if (codes_row, angles_row) in seen:
+                continue
+            seen.append((codes_row, angles_row))
+            choices.append((ctype, flip))
+            place_codes.append(codes_row)
+            place_angles.append(angles_row)
+
+    return (choices, np.array(start_codes, dtype=np.int8), np.array(place_codes, dtype=np.int8),
+            np.array(place_angles, dtype=np.int8), np.array(next_rows, dtype=np.int8))
+
+def advance_walk(grid, pos, angle, steps, alive, next_table, chessboard_size, max_steps=50):
+    # Step every alive walk with an angle set until it stops or needs a new chess,
+    # mirroring ChessBoard.count_steps. Returns the mask of walks waiting on an empty cell.
+    delta = np.array(ChessTemplate._angle_pos, dtype=np.int64)
+    size = np.array(chessboard_size)
+    moving = alive.copy()
+    pending = np.zeros_like(alive)
+    while True:
+        # Leave the cell in the current angle direction
+        idx = np.flatnonzero(moving)
+        steps[idx] += 1
+        alive[idx[steps[idx] > max_steps]] = False
+        pos[idx] += delta[angle[idx]]
+        off_board = ((pos[idx] < 0) | (pos[idx] >= size)).any(axis=1)
+        alive[idx[off_board]] = False
+        moving &= alive
+        # Pass through chesses already on the board
+        idx = np.flatnonzero(moving)
+        if len(idx) == 0:
+            return pending
+        cell = grid[idx, pos[idx, 0], pos[idx, 1]]
+        empty = cell == 0
+        pending[idx[empty]] = True
+        moving[idx[empty]] = False
+        idx, cell = idx[~empty], cell[~empty]
+        angle[idx] = next_table[cell, angle[idx]]
+        blocked = angle[idx] < 0
+        alive[idx[blocked]] = False
+        moving[idx[blocked]] = False
+
+def reachable_cells(grid, pos):
+    # 8-neighbour flood fill through empty cells from each walk's current position
+    empty = grid == 0
+    n = len(grid)
+    reach = np.zeros_like(empty)
+    reach[np.arange(n), pos[:, 0], pos[:, 1]] = True
+    while True:
+        padded = np.pad(reach, ((0, 0), (1, 1), (1, 1)))
+        grown = np.zeros_like(reach)
+        for dx in (0, 1, 2):
+            for dy in (0, 1, 2):
+                grown |= padded[:, dx:dx + reach.shape[1], dy:dy + reach.shape[2]]
+        grown &= empty
+        if (grown == reach).all():
+            return reach.sum(axis=(1, 2))
+        reach = grown
+
+def beam_search(beam_width=2000, chessboard_size=(6, 6)):
+    choices, start_codes, place_codes, place_angles, next_table = build_move_tables()
+    budget = np.array(list(chess_countr.values()), dtype=np.int64)
+    max_x, max_y = chessboard_size
+
+    # Every start position and angle
+    xs, ys, angles = np.meshgrid(np.arange(max_x), np.arange(max_y), np.arange(8), indexing="ij")
+    n = xs.size
+    start_pos = np.stack([xs.ravel(), ys.ravel()], axis=1)
+    start_angle = angles.ravel()
+    grid = np.zeros((n, max_x, max_y), dtype=np.int8)
+    grid[np.arange(n), start_pos[:, 0], start_pos[:, 1]] = start_codes[start_angle]
+    pos = start_pos.copy()
+    angle = start_angle.astype(np.int64)
+    steps = np.zeros(n, dtype=np.int64)
+    alive = np.ones(n, dtype=bool)
+    counts = np.tile(budget, (n, 1))
+    history = np.zeros((n, 0), dtype=np.int64)
+    pending = advance_walk(grid, pos, angle, steps, alive, next_table, chessboard_size)
+
+    best_steps, best_state = 0, None
+
+    def keep_best(mask):
+        nonlocal best_steps, best_state
+        if mask.any():
+            i = np.flatnonzero(mask)[np.argmax(steps[mask])]
+            if steps[i] > best_steps:
+                best_steps = int(steps[i])
+                best_state = (tuple(start_pos[i]), int(start_angle[i]), history[i].tolist())
+
+    keep_best(~pending)
+    while pending.any():
+        # All chesses used up: the end chess takes the empty cell
+        done = pending & (counts.sum(axis=1) == 0)
+        steps[done] += 2
+        keep_best(done)
+        keep = pending & ~done
+        if not keep.any():
+            break
+        start_pos, start_angle, grid, pos, angle, steps, counts, history = (
+            a[keep] for a in (start_pos, start_angle, grid, pos, angle, steps, counts, history))
+
+        # Expand every beam state by every chess choice still in budget
+        n, k = len(grid), len(choices)
+        choice = np.tile(np.arange(k), n)
+        parent = np.repeat(np.arange(n), k)
+        choice_type = np.array([list(chess_countr).index(c[0]) for c in choices])[choice]
+        valid = counts[parent, choice_type] > 0
+        choice, parent, choice_type = choice[valid], parent[valid], choice_type[valid]
+        start_pos, start_angle, grid, pos, angle, steps, counts, history = (
+            a[parent].copy() for a in (start_pos, start_angle, grid, pos, angle, steps, counts, history))
+        n = len(grid)
+        rows = np.arange(n)
+        grid[rows, pos[:, 0], pos[:, 1]] = place_codes[choice, angle]
+        angle = place_angles[choice, angle].astype(np.int64)
+        counts[rows, choice_type] -= 1
+        history = np.concatenate([history, choice[:, None]], axis=1)
+        alive = angle >= 0
+        pending = advance_walk(grid, pos, angle, steps, alive, next_table, chessboard_size)
+        keep_best(~pending)
+
+        # Score the open walks and keep the top distinct states
+        idx = np.flatnonzero(pending)
+        if len(idx) == 0:
+            break
+        remaining = counts[idx].sum(axis=1)
+        score = steps[idx] + np.minimum(reachable_cells(grid[idx], pos[idx]), remaining)
+        idx = idx[np.argsort(-score, kind="stable")]
+        key = np.concatenate([grid[idx].reshape(len(idx), -1), pos[idx], angle[idx, None], counts[idx]],
+                             axis=1).astype(np.int8)
+        _, first = np.unique(key, axis=0, return_index=True)
+        idx = idx[np.sort(first)[:beam_width]]
+        pending = np.zeros(n, dtype=bool)
+        pending[idx] = True
+
+    # Rebuild the best walk as an individual, unused chesses go after the consumed prefix
+    start, start_angle, picked = best_state
+    chess_seq = [choices[c][0] for c in picked]
+    flip_seq = [choices[c][1] for c in picked]
+    for ctype, count in chess_countr.items():
+        chess_seq.extend([ctype] * (count - chess_seq.count(ctype)))
+    flip_seq.extend([False] * (len(chess_seq) - len(flip_seq)))
+    best = Individual(start, start_angle, chess_seq, flip_seq)
+    best.calculate_fitness(chessboard_size)
+    print(f"Best Fitness: {best.fitness}, beam width: {beam_width}")
+    return best
 
 if __name__ == '__main__':
     import logging
 
     file_path = "./best.txt"
     best_fitness = 0
+    # Every GA run starts from a population holding the beam-search board
+    seed = beam_search()
     # best, index = GeneticAlgorithm(100, 1000)
     # print(f"best fitness: {best.fitness}, index: {index} / 1000 \n {best.board}")
     for population_size in range(1000, 5000, 500):
         for max_generations in range(1500, 5000, 200):
-            best = genetic_algorithm(population_size, max_generations)
+            best = genetic_algorithm(population_size, max_generations, seeds=[seed])
             if best.fitness > best_fitness:
                 best_fitness = best.fitness
                 with open(file_path, "a", encoding="utf-8") as f: